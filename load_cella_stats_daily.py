@@ -8,14 +8,33 @@ options or environment variables.
 """
 from __future__ import annotations
 
+import csv
+import glob
+import hashlib
+import importlib.util
+import io
+import math
 import os
-from datetime import date, datetime, timedelta
-from decimal import Decimal
-from typing import Dict, Optional
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import (
+    Callable,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
 import pandas as pd
 import psycopg2
 from psycopg2 import sql
+from psycopg2.pool import SimpleConnectionPool
 from dateutil import parser as date_parser, tz
 
 
@@ -36,8 +55,15 @@ DATE_COL = "Плановая дата поставки"
 CELLA_COL = "Cella"
 CSV_CELLA_COL = "cella"
 CELLA: Optional[str] = None  # Process all Cellas by default
+# ISO dates (e.g. "2025-08-26") to backfill in one run; when empty, the
+# previous working day is processed.
+STATS_DATES: List[str] = []
 TZ_NAME = "Europe/Moscow"
 
+# Results parsed from the input files are cached here as parquet, keyed by
+# path, mtime and size; only the newest entry per path is kept
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cella_stats")
+
 # PostgreSQL connection
 HOST = "192.168.3.19"
 PORT = 5432
@@ -52,28 +78,39 @@ TABLE = "execution-of-orders"
 # Helpers
 # ---------------------------------------------------------------------------
 
+# (stats_date, cella, partial_count, full_count, expected)
+StatsRow = Tuple[date, str, Optional[int], Optional[int], Optional[float]]
+
+
+# Folds "ё"/"Ё" to "е" and drops spaces in a single ``str.translate`` pass
+_COLNAME_TRANS = str.maketrans({"ё": "е", "Ё": "е", " ": None})
+
+
+@lru_cache(maxsize=256)
 def normalize_colname(name: str) -> str:
     """Normalize a column name for comparison.
 
     Lower case, strip spaces, replace "ё" with "е".
     """
-    return name.lower().replace("ё", "е").replace(" ", "")
+    return name.translate(_COLNAME_TRANS).lower()
 
 
-def find_expected_column(df: pd.DataFrame) -> str:
+def find_expected_column(columns: Iterable[str]) -> str:
     """Find the column representing expected quantity in the forecast file.
 
     Exact match is performed on the normalized name. If no exact match is
     found, a substring search for "ожид" is used.
     """
-    normalized = {col: normalize_colname(col) for col in df.columns}
-    for col, norm in normalized.items():
+    fallback = None
+    for col in columns:
+        norm = normalize_colname(col)
         if norm == "ожидается":
             return col
-    for col, norm in normalized.items():
-        if "ожид" in norm:
-            return col
-    raise ValueError("Column 'Ожидается' not found in forecast file")
+        if fallback is None and "ожид" in norm:
+            fallback = col
+    if fallback is None:
+        raise ValueError("Column 'Ожидается' not found in forecast file")
+    return fallback
 
 
 def determine_stats_date(date_str: Optional[str], tz_name: Optional[str]) -> date:
@@ -88,54 +125,307 @@ def determine_stats_date(date_str: Optional[str], tz_name: Optional[str]) -> dat
     return today - timedelta(days=1)
 
 
-def count_xls_rows(
-    path: str, date_col: str, cella_col: str, stats_date: date, cella: Optional[str]
-) -> pd.Series:
-    """Count rows in an XLS file for the given date grouped by Cella."""
+def load_cached(
+    path: str, loader: Callable[[], pd.DataFrame], tag: str = ""
+) -> pd.DataFrame:
+    """Return ``loader()`` for ``path``, reusing a parquet copy when possible.
+
+    The cache key is built from the path, modification time and size of the
+    file plus ``tag``, which callers use to tell apart different projections
+    of the same file. Only the newest entry per path is kept: writing one
+    removes the others. The cache is best effort, so a failure to read or
+    write it never fails the load.
+    """
+    stat = os.stat(path)
+    source = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    key = hashlib.sha1(
+        f"{stat.st_mtime_ns}|{stat.st_size}|{tag}".encode()
+    ).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{source}-{key}.parquet")
+
+    if os.path.exists(cache_path):
+        try:
+            return pd.read_parquet(cache_path)
+        except Exception:
+            pass
+
+    df = loader()
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
     try:
-        df = pd.read_excel(path, engine="xlrd")
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_parquet(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except Exception:
+        with suppress(OSError):
+            os.remove(tmp_path)
+        return df
+
+    for old_path in glob.glob(os.path.join(CACHE_DIR, f"{source}-*.parquet")):
+        if old_path != cache_path:
+            with suppress(OSError):
+                os.remove(old_path)
+    return df
+
+
+def read_if_remote(path: str) -> Optional[bytes]:
+    """Return the contents of ``path`` if it lives on a network share.
+
+    Workbook readers issue many small random reads, each of which is a round
+    trip over SMB. Fetching a UNC path with one sequential read and parsing it
+    from memory avoids that. ``None`` is returned for local paths.
+    """
+    if not path.startswith(("\\\\", "//")):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def open_calamine_workbook(path: str, data: Optional[bytes]):
+    """Open ``path`` with python-calamine, from ``data`` when it was fetched.
+
+    Kept separate from :func:`iter_xls_rows` so the fetched bytes, which the
+    reader copies, are not referenced by the generator during the scan.
+    """
+    from python_calamine import CalamineWorkbook
+
+    if data is not None:
+        return CalamineWorkbook.from_filelike(io.BytesIO(data))
+    return CalamineWorkbook.from_path(path)
+
+
+def open_xlrd_workbook(path: str, data: Optional[bytes]):
+    """Open ``path`` with xlrd, from ``data`` when it was fetched."""
+    import xlrd
+
+    if data is not None:
+        return xlrd.open_workbook(file_contents=data, on_demand=True)
+    return xlrd.open_workbook(path, on_demand=True)
+
+
+def iter_xls_rows(path: str) -> Iterator[List[object]]:
+    """Yield the rows of the first sheet of an XLS report, header included.
+
+    Rows are read with ``python-calamine``; ``xlrd`` is only used as a
+    fallback. Both readers load the whole sheet, but the row lists are built
+    one at a time as they are yielded. Date cells are returned as
+    ``datetime`` by both readers.
+    """
+    if importlib.util.find_spec("python_calamine") is not None:
+        workbook = open_calamine_workbook(path, read_if_remote(path))
+        yield from workbook.get_sheet_by_index(0).iter_rows()
+        return
+
+    try:
+        import xlrd
     except ImportError as exc:  # pragma: no cover - dependency check
         raise SystemExit(
-            "Missing optional dependency 'xlrd'. Install it with 'pip install xlrd'."
+            "Missing optional dependency 'python-calamine' or 'xlrd'. Install it "
+            "with 'pip install python-calamine'."
         ) from exc
-    if cella:
-        df = df[df[cella_col] == cella]
-    # Dates in the reports follow the format ``dd.mm.yyyy HH:MM:SS``
-    # (e.g. ``26.08.2025 13:30:58``). Parse with an explicit format to
-    # avoid ambiguous date warnings and then drop the time component.
-    df[date_col] = pd.to_datetime(
-        df[date_col], errors="coerce", format="%d.%m.%Y %H:%M:%S"
-    ).dt.date
-    df = df[df[date_col] == stats_date]
-    return df.groupby(cella_col).size()
 
+    book = open_xlrd_workbook(path, read_if_remote(path))
+    try:
+        for cells in book.sheet_by_index(0).get_rows():
+            yield [
+                xlrd.xldate_as_datetime(cell.value, book.datemode)
+                if cell.ctype == xlrd.XL_CELL_DATE
+                else cell.value
+                for cell in cells
+            ]
+    finally:
+        book.release_resources()
+
+
+def cell_text(value: object) -> str:
+    """Return the text of a Cella cell.
+
+    Whole numbers come back from the readers as floats and are written
+    without the trailing ``.0``. Empty cells yield an empty string.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
 
-def compute_expected(path: str, cella_col: str) -> Dict[str, Decimal]:
-    """Compute expected values from CSV forecast file grouped by Cella."""
-    df = pd.read_csv(path, sep=None, engine="python")
-    col = find_expected_column(df)
-    df[col] = pd.to_numeric(df[col], errors="coerce")
-    df = df.dropna(subset=[col])
 
-    if cella_col not in df.columns:
-        raise ValueError(f"Column '{cella_col}' not found in forecast file")
+def match_date_text(text: str, days: Dict[str, date]) -> Optional[date]:
+    """Return the day of a textual report date if it is one of ``days``.
 
-    grouped = df.groupby(cella_col)[col].sum()
-    return {str(c): Decimal(str(v)) for c, v in grouped.items()}
+    Dates in the reports follow the format ``dd.mm.yyyy HH:MM:SS`` (e.g.
+    ``26.08.2025 13:30:58``). ``days`` maps the ``dd.mm.yyyy`` part to the
+    dates of interest, so the date is found with a dict lookup and only the
+    time part is validated; no ``strptime`` call is made per row.
+    """
+    day = days.get(text[:10])
+    if day is None or len(text) != 19 or (text[10], text[13], text[16]) != (" ", ":", ":"):
+        return None
+    try:
+        time.fromisoformat(text[11:])
+    except ValueError:
+        return None
+    return day
+
+
+def scan_xls_counts(
+    path: str,
+    date_col: str,
+    cella_col: str,
+    stats_dates: List[date],
+    cella: Optional[str],
+) -> pd.Series:
+    """Scan an XLS report and count rows per stats date and Cella.
 
+    The rows are counted into a counter per (date, Cella) pair as they are
+    iterated; no DataFrame or per-row Python objects are kept. The reader
+    itself still loads the whole sheet. The result is indexed by
+    ``("stats_date", cella_col)``.
+    """
+    rows = iter_xls_rows(path)
+    header = [cell_text(value) for value in next(rows, [])]
+    for col in (date_col, cella_col):
+        if col not in header:
+            raise ValueError(f"Column '{col}' not found in {path}")
+    date_idx = header.index(date_col)
+    cella_idx = header.index(cella_col)
+
+    wanted = set(stats_dates)
+    days = {d.strftime("%d.%m.%Y"): d for d in wanted}
+    counts: Counter[Tuple[date, str]] = Counter()
+    for row in rows:
+        key = row[cella_idx]
+        # Cella codes are almost always text; only other cells need converting.
+        if type(key) is not str:
+            key = cell_text(key)
+        if not key or (cella and key != cella):
+            continue
+        value = row[date_idx]
+        # Date cells come back as ``datetime`` from the readers; exports that
+        # store the date as text are matched without parsing it.
+        if isinstance(value, str):
+            day = match_date_text(value, days)
+        elif isinstance(value, datetime):
+            day = value.date()
+        elif isinstance(value, date):
+            day = value
+        else:
+            continue
+        if day in wanted:
+            counts[(day, key)] += 1
+
+    index = pd.MultiIndex.from_tuples(list(counts), names=["stats_date", cella_col])
+    return pd.Series(list(counts.values()), index=index, dtype="int64")
 
-def upsert_stats(
-    conn: psycopg2.extensions.connection,
-    schema: str,
-    table: str,
-    stats_date: date,
-    cella: str,
-    partial_count: Optional[int],
-    full_count: Optional[int],
-    expected: Optional[Decimal],
-):
-    """Create tables if necessary and upsert statistics."""
+
+def count_xls_rows(
+    path: str,
+    date_col: str,
+    cella_col: str,
+    stats_dates: List[date],
+    cella: Optional[str],
+) -> Dict[date, pd.Series]:
+    """Count rows in an XLS file for each of the given dates grouped by Cella.
+
+    The report is read once regardless of the number of dates.
+    """
+    counts = load_cached(
+        path,
+        lambda: scan_xls_counts(
+            path, date_col, cella_col, stats_dates, cella
+        ).to_frame("count"),
+        tag="|".join(
+            [cella_col, date_col, cella or ""]
+            + sorted(d.isoformat() for d in stats_dates)
+        ),
+    )["count"]
+
+    # There are only a handful of (date, Cella) pairs, so they are split per
+    # date with plain dicts rather than a pandas groupby.
+    by_date: Dict[date, Dict[str, int]] = {d: {} for d in stats_dates}
+    for (day, key), n in counts.items():
+        # Dates may come back from the parquet cache as Timestamps.
+        by_date[pd.Timestamp(day).date()][key] = int(n)
+    return {d: pd.Series(c, dtype="int64", name="count") for d, c in by_date.items()}
+
+
+def sniff_delimiter(sample: str) -> str:
+    """Detect the delimiter of a CSV file from a sample of its first lines.
+
+    When the sample is inconclusive (e.g. ragged rows), the candidate that
+    occurs most often in the header line is used.
+    """
+    candidates = ";,\t|"
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=candidates).delimiter
+    except csv.Error:
+        header = sample.split("\n", 1)[0]
+        return max(candidates, key=header.count)
+
+
+def compute_expected(path: str, cella_col: str) -> Dict[str, float]:
+    """Compute expected values from CSV forecast file grouped by Cella.
+
+    The file is streamed with the ``csv`` module and summed per Cella; rows
+    whose expected value is not a number are skipped. Totals are returned as
+    floats; the ``NUMERIC(18,2)`` column rounds them when they are stored.
+    """
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        # Sniff from the same handle so the share is opened only once.
+        delimiter = sniff_delimiter(f.read(8192))
+        f.seek(0)
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader, [])
+        ei = header.index(find_expected_column(header))
+        # Match the Cella header the same way as the expected column, so
+        # stray spaces or case differences in the export do not break it.
+        target = normalize_colname(cella_col)
+        normalized = [normalize_colname(name) for name in header]
+        if target not in normalized:
+            raise ValueError(f"Column '{cella_col}' not found in forecast file")
+        ci = normalized.index(target)
+        width = max(ci, ei)
+
+        totals: DefaultDict[str, float] = defaultdict(float)
+        for row in reader:
+            if len(row) <= width or not row[ci]:
+                continue
+            try:
+                value = float(row[ei].replace(",", "."))
+            except ValueError:
+                continue
+            if not math.isnan(value):
+                totals[row[ci]] += value
+
+    return dict(totals)
+
+
+@contextmanager
+def pooled_connection(
+    pool: SimpleConnectionPool,
+) -> Iterator[psycopg2.extensions.connection]:
+    """Borrow a connection from ``pool`` and return it when done."""
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+def ensure_table(conn: psycopg2.extensions.connection, schema: str, table: str) -> None:
+    """Create the target schema and table if they do not exist yet.
+
+    Nothing is committed here; the statements become part of the caller's
+    transaction so the DDL check and the upsert share a single commit. When
+    the table already exists, the check is a single catalog lookup.
+    """
     with conn.cursor() as cur:
+        cur.execute(
+            "SELECT 1 FROM information_schema.tables "
+            "WHERE table_schema = %s AND table_name = %s",
+            (schema, table),
+        )
+        if cur.fetchone():
+            return
         cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}" ).format(sql.Identifier(schema)))
         cur.execute(
             sql.SQL(
@@ -152,23 +442,71 @@ def upsert_stats(
                 """
             ).format(sql.Identifier(schema), sql.Identifier(table))
         )
+
+
+def upsert_stats(
+    conn: psycopg2.extensions.connection,
+    schema: str,
+    table: str,
+    rows: List[StatsRow],
+    forecast_date: date,
+) -> Dict[Tuple[date, str], int]:
+    """Upsert statistics rows in one batch and return their record ids.
+
+    Each row is ``(stats_date, cella, partial_count, full_count, expected)``
+    and the returned ids are keyed by ``(stats_date, cella)``. The rows are
+    streamed with ``COPY`` into a temporary staging table and merged into
+    the target table with a single ``INSERT ... SELECT``. Nothing is
+    committed here; the caller owns the transaction.
+
+    The forecast file only describes ``forecast_date``; for existing rows of
+    any other (backfilled) date the stored ``expected`` value is kept.
+    """
+    buf = io.StringIO()
+    # ``None`` is written as an unquoted empty field, which COPY reads as NULL.
+    # Floats are written as their repr and rounded half away from zero by the
+    # NUMERIC(18,2) staging column, as a ``Decimal(str(value))`` would be.
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TEMP TABLE _stg (
+                stats_date DATE,
+                cella TEXT,
+                partial_count INT,
+                full_count INT,
+                expected NUMERIC(18,2)
+            ) ON COMMIT DROP
+            """
+        )
+        cur.copy_expert(
+            "COPY _stg (stats_date, cella, partial_count, full_count, expected) "
+            "FROM STDIN WITH CSV",
+            buf,
+        )
         cur.execute(
             sql.SQL(
                 """
-                INSERT INTO {}.{} (stats_date, cella, partial_count, full_count, expected)
-                VALUES (%s, %s, %s, %s, %s)
+                INSERT INTO {}.{} AS t
+                    (stats_date, cella, partial_count, full_count, expected)
+                SELECT stats_date, cella, partial_count, full_count, expected
+                FROM _stg
                 ON CONFLICT (cella, stats_date) DO UPDATE
                 SET partial_count = EXCLUDED.partial_count,
                     full_count = EXCLUDED.full_count,
-                    expected = EXCLUDED.expected
-                RETURNING id
+                    expected = CASE
+                        WHEN EXCLUDED.stats_date = %s THEN EXCLUDED.expected
+                        ELSE t.expected
+                    END
+                RETURNING stats_date, cella, id
                 """
             ).format(sql.Identifier(schema), sql.Identifier(table)),
-            (stats_date, cella, partial_count, full_count, expected),
+            (forecast_date,),
         )
-        row_id = cur.fetchone()[0]
-        conn.commit()
-        return row_id
+        returned = cur.fetchall()
+    return {(stats_date, cella): row_id for stats_date, cella, row_id in returned}
 
 
 # ---------------------------------------------------------------------------
@@ -178,7 +516,9 @@ def upsert_stats(
 def main() -> None:
     cella = CELLA
     tz_name = TZ_NAME
-    stats_date = determine_stats_date(None, tz_name)
+    stats_dates = sorted({determine_stats_date(d, tz_name) for d in STATS_DATES}) or [
+        determine_stats_date(None, tz_name)
+    ]
 
     partial_path = PARTIAL_XLS
     full_path = FULL_XLS
@@ -196,7 +536,7 @@ def main() -> None:
     schema = SCHEMA
     table = TABLE
 
-    print(f"Stats date: {stats_date}")
+    print("Stats dates:", ", ".join(str(d) for d in stats_dates))
     print(
         "Parameters:",
         {
@@ -217,55 +557,90 @@ def main() -> None:
         },
     )
 
-    partial_counts = count_xls_rows(
-        partial_path, date_col, cella_col, stats_date, cella
-    )
-    full_counts = count_xls_rows(full_path, date_col, cella_col, stats_date, cella)
-    expected_map = compute_expected(forecast_path, csv_cella_col)
-
-    if cella:
-        cellas = {cella}
-    else:
-        cellas = set(partial_counts.index) | set(full_counts.index) | set(expected_map.keys())
-
-    conn = psycopg2.connect(
+    # The reports live on a network share; read and parse them concurrently.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        partial_future = executor.submit(
+            count_xls_rows, partial_path, date_col, cella_col, stats_dates, cella
+        )
+        # Both reports may point at the same workbook; read it only once then.
+        if os.path.normcase(os.path.abspath(full_path)) == os.path.normcase(
+            os.path.abspath(partial_path)
+        ):
+            full_future = partial_future
+        else:
+            full_future = executor.submit(
+                count_xls_rows, full_path, date_col, cella_col, stats_dates, cella
+            )
+        expected_future = executor.submit(compute_expected, forecast_path, csv_cella_col)
+        partial_by_date = partial_future.result()
+        full_by_date = full_future.result()
+        expected_map = expected_future.result()
+
+    pool = SimpleConnectionPool(
+        1,
+        4,
         host=host,
         port=port,
         dbname=dbname,
         user=user,
         password=password,
     )
+    try:
+        # The forecast file has no date; it belongs to the latest stats date
+        # only. Backfilled dates get no expected value and keep the stored one.
+        forecast_date = stats_dates[-1]
+        rows: List[StatsRow] = []
+        for stats_date in stats_dates:
+            partial_counts = partial_by_date[stats_date]
+            full_counts = full_by_date[stats_date]
+            date_expected = expected_map if stats_date == forecast_date else {}
+            if cella:
+                cellas = pd.Index([cella])
+            else:
+                # Index.union skips sorting when one side is empty, hence the
+                # explicit sort_values().
+                cellas = (
+                    partial_counts.index.union(full_counts.index)
+                    .union(pd.Index(list(date_expected)))
+                    .sort_values()
+                )
 
-    for c in sorted(cellas):
-        pc_val = partial_counts.get(c)
-        partial_count = int(pc_val) if pc_val is not None and not pd.isna(pc_val) else None
-        fc_val = full_counts.get(c)
-        full_count = int(fc_val) if fc_val is not None and not pd.isna(fc_val) else None
-        expected = expected_map.get(c)
-
-        print(
-            "Computed metrics:",
-            {
-                "cella": c,
-                "partial_count": partial_count,
-                "full_count": full_count,
-                "expected": float(expected) if expected is not None else None,
-            },
-        )
-
-        record_id = upsert_stats(
-            conn,
-            schema,
-            table,
-            stats_date,
-            c,
-            partial_count,
-            full_count,
-            expected,
-        )
-        print("DB record id:", record_id)
-
-    conn.close()
+            for c in cellas:
+                pc_val = partial_counts.get(c)
+                partial_count = (
+                    int(pc_val) if pc_val is not None and not pd.isna(pc_val) else None
+                )
+                fc_val = full_counts.get(c)
+                full_count = (
+                    int(fc_val) if fc_val is not None and not pd.isna(fc_val) else None
+                )
+                expected = date_expected.get(c)
+
+                print(
+                    "Computed metrics:",
+                    {
+                        "stats_date": str(stats_date),
+                        "cella": c,
+                        "partial_count": partial_count,
+                        "full_count": full_count,
+                        "expected": expected,
+                    },
+                )
+                rows.append((stats_date, c, partial_count, full_count, expected))
+
+        if rows:
+            # One transaction for the whole load: ``with conn`` commits once
+            # on success and rolls back if anything fails.
+            with pooled_connection(pool) as conn, conn:
+                ensure_table(conn, schema, table)
+                record_ids = upsert_stats(conn, schema, table, rows, forecast_date)
+            for (stats_date, c), record_id in sorted(record_ids.items()):
+                print(
+                    "DB record id:",
+                    {"stats_date": str(stats_date), "cella": c, "id": record_id},
+                )
+    finally:
+        pool.closeall()
 
 
 if __name__ == "__main__":